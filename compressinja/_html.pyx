@@ -0,0 +1,160 @@
+# cython: language_level=3, binding=True
+"""
+    C implementation of
+    :meth:`compressinja.html.HtmlCompressor.normalize_uncached`, which
+    :meth:`~compressinja.html.HtmlCompressor.normalize` wraps with the
+    token cache.
+
+    The token is scanned as UTF-8 bytes.  Everything the state machine
+    looks at (tag names, ``<``, ``>`` and whitespace) is ASCII, so multibyte
+    sequences are copied through untouched.  Tag bookkeeping is still done
+    by the compressor's ``enter_tag`` and ``leave_tag`` so subclasses keep
+    working.
+
+    :copyright: (c) 2011 by Armin Ronacher and Feldman Stanislav.
+    :license: BSD, see LICENSE for more details.
+"""
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+from cpython.object cimport PyObject
+from cpython.ref cimport Py_XDECREF
+
+
+cdef extern from *:
+    """
+    /* Python 3 keeps a UTF-8 copy of every str (the str data itself for
+       ASCII) that can be borrowed.  Lone surrogates have no UTF-8 form,
+       those strings are encoded with surrogatepass instead.  Python 2 has
+       to encode. */
+    #if PY_MAJOR_VERSION >= 3
+    static const char *cz_as_utf8(PyObject *s, Py_ssize_t *n,
+                                  PyObject **owner)
+    {
+        const char *rv = PyUnicode_AsUTF8AndSize(s, n);
+        *owner = NULL;
+        if (rv != NULL || !PyErr_ExceptionMatches(PyExc_UnicodeEncodeError))
+            return rv;
+        PyErr_Clear();
+        *owner = PyUnicode_AsEncodedString(s, "utf-8", "surrogatepass");
+        if (*owner == NULL)
+            return NULL;
+        *n = PyBytes_GET_SIZE(*owner);
+        return PyBytes_AS_STRING(*owner);
+    }
+    #else
+    static const char *cz_as_utf8(PyObject *s, Py_ssize_t *n,
+                                  PyObject **owner)
+    {
+        if (PyString_Check(s)) {
+            Py_INCREF(s);
+            *owner = s;
+        }
+        else if ((*owner = PyUnicode_AsUTF8String(s)) == NULL)
+            return NULL;
+        *n = PyString_GET_SIZE(*owner);
+        return PyString_AS_STRING(*owner);
+    }
+    #endif
+    """
+    const char *cz_as_utf8(object s, Py_ssize_t *n, PyObject **owner) \
+        except NULL
+
+
+cdef extern from "_simd.h":
+    size_t cz_find_special(const unsigned char *s, size_t n,
+                           bint collapse) nogil
+
+
+# byte classes for the runs scanned after a decision point, looked up once
+# per byte instead of chains of comparisons
+DEF COLLAPSIBLE = 1     # whitespace runs that get collapsed to one space
+DEF TAG_SPACE = 2       # whitespace swallowed after a tag name
+DEF NAME = 4            # tag name characters
+
+cdef unsigned char char_class[256]
+
+
+cdef void init_char_class():
+    cdef int ch
+    for ch in range(256):
+        char_class[ch] = 0
+    for ch in b' \t\r\n':
+        char_class[ch] |= COLLAPSIBLE | TAG_SPACE
+    for ch in b'\f\v':
+        char_class[ch] |= TAG_SPACE
+    for ch in b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-':
+        char_class[ch] |= NAME
+
+
+init_char_class()
+
+
+def normalize(self, ctx):
+    cdef object value = ctx.token.value
+    cdef PyObject *owner = NULL
+    cdef Py_ssize_t n
+    cdef const unsigned char *src = <const unsigned char *>cz_as_utf8(
+        value, &n, &owner)
+    cdef Py_ssize_t i = 0, j = 0, start, name_start, name_end, run
+    cdef bint closes
+    enter_tag, leave_tag = self.enter_tag, self.leave_tag
+    isolated = self.isolated_elements
+    cdef bint collapse = not ctx.isolated_depth or ctx.in_tag in isolated
+    cdef unsigned char ch
+    cdef char *out = <char *>malloc(n + 1)
+    if out == NULL:
+        Py_XDECREF(owner)
+        raise MemoryError()
+
+    try:
+        while i < n:
+            # copy everything up to the next byte that needs a decision
+            run = cz_find_special(src + i, n - i, collapse)
+            if run:
+                memcpy(out + j, src + i, run)
+                i += run
+                j += run
+                continue
+            ch = src[i]
+            if ch == b'<':
+                start = i
+                closes = i + 1 < n and src[i + 1] == b'/'
+                name_start = name_end = start + 1 + closes
+                while name_end < n and char_class[src[name_end]] & NAME:
+                    name_end += 1
+                if name_end == name_start:
+                    out[j] = ch
+                    j += 1
+                    i += 1
+                    continue
+                i = name_end
+                while i < n and char_class[src[i]] & TAG_SPACE:
+                    i += 1
+                memcpy(out + j, src + start, i - start)
+                j += i - start
+                tag = (<const char *>src)[name_start:name_end].decode('ascii')
+                # in an isolated element only its own end tag is markup
+                if not ctx.isolated_depth or \
+                        closes and tag == ctx.stack[-1]:
+                    if closes:
+                        leave_tag(tag, ctx)
+                    else:
+                        enter_tag(tag, ctx)
+                    ctx.in_tag = tag
+                    collapse = not ctx.isolated_depth or tag in isolated
+            elif ch == b'>':
+                out[j] = ch
+                j += 1
+                i += 1
+                ctx.in_tag = None
+                collapse = not ctx.isolated_depth
+            else:
+                out[j] = b' '
+                j += 1
+                i += 1
+                while i < n and char_class[src[i]] & COLLAPSIBLE:
+                    i += 1
+        return out[:j].decode('utf-8', 'surrogatepass')
+    finally:
+        free(out)
+        Py_XDECREF(owner)
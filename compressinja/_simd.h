@@ -0,0 +1,116 @@
+/*
+ * Vectorized scanning for compressinja._html.
+ *
+ * cz_find_special() returns the offset of the first byte the normalize
+ * state machine has to look at, or n if there is none.  Those are '<',
+ * '>' and, while whitespace is being collapsed, tab, CR, LF and a space
+ * followed by more whitespace.  A lone space is already normalized and is
+ * copied like any other byte.
+ *
+ * With AVX2 enabled at compile time 32 bytes are classified per step,
+ * otherwise SSE2 (always available on x86-64) does 16.  Other targets use
+ * the scalar loop, which also handles the tail of every buffer.
+ *
+ * :copyright: (c) 2011 by Armin Ronacher and Feldman Stanislav.
+ * :license: BSD, see LICENSE for more details.
+ */
+#ifndef COMPRESSINJA_SIMD_H
+#define COMPRESSINJA_SIMD_H
+
+#include <stddef.h>
+
+#if defined(__AVX2__)
+#  include <immintrin.h>
+#  define CZ_AVX2 1
+#elif defined(__SSE2__) || defined(_M_X64) || \
+      (defined(_M_IX86_FP) && _M_IX86_FP >= 2)
+#  include <emmintrin.h>
+#  define CZ_SSE2 1
+#endif
+
+#if defined(CZ_AVX2) || defined(CZ_SSE2)
+#  if defined(_MSC_VER)
+#    include <intrin.h>
+static int cz_ctz(unsigned int bits)
+{
+    unsigned long idx;
+    _BitScanForward(&idx, bits);
+    return (int)idx;
+}
+#  else
+#    define cz_ctz(bits) __builtin_ctz(bits)
+#  endif
+#endif
+
+static int cz_is_ws(unsigned char ch)
+{
+    return ch == ' ' || ch == '\t' || ch == '\r' || ch == '\n';
+}
+
+static size_t cz_find_special_scalar(const unsigned char *s,
+                                     size_t i, size_t n, int collapse)
+{
+    unsigned char ch;
+    for (; i < n; i++) {
+        ch = s[i];
+        if (ch == '<' || ch == '>')
+            return i;
+        if (collapse && (ch == '\t' || ch == '\r' || ch == '\n' ||
+                         (ch == ' ' && i + 1 < n && cz_is_ws(s[i + 1]))))
+            return i;
+    }
+    return n;
+}
+
+#if defined(CZ_AVX2)
+
+#define CZ_BLOCK 32
+#define cz_vec __m256i
+#define cz_load(p) _mm256_loadu_si256((const __m256i *)(p))
+#define cz_eq(v, c) _mm256_cmpeq_epi8((v), _mm256_set1_epi8(c))
+#define cz_or _mm256_or_si256
+#define cz_and _mm256_and_si256
+#define cz_movemask(v) ((unsigned int)_mm256_movemask_epi8(v))
+
+#elif defined(CZ_SSE2)
+
+#define CZ_BLOCK 16
+#define cz_vec __m128i
+#define cz_load(p) _mm_loadu_si128((const __m128i *)(p))
+#define cz_eq(v, c) _mm_cmpeq_epi8((v), _mm_set1_epi8(c))
+#define cz_or _mm_or_si128
+#define cz_and _mm_and_si128
+#define cz_movemask(v) ((unsigned int)_mm_movemask_epi8(v))
+
+#endif
+
+static size_t cz_find_special(const unsigned char *s, size_t n,
+                              int collapse)
+{
+    size_t i = 0;
+#ifdef CZ_BLOCK
+    cz_vec v, next, mask, breaks, ws_next;
+    unsigned int bits;
+
+    /* one extra byte is read to see what follows a space */
+    while (i + CZ_BLOCK < n) {
+        v = cz_load(s + i);
+        mask = cz_or(cz_eq(v, '<'), cz_eq(v, '>'));
+        if (collapse) {
+            next = cz_load(s + i + 1);
+            breaks = cz_or(cz_eq(v, '\t'),
+                           cz_or(cz_eq(v, '\r'), cz_eq(v, '\n')));
+            ws_next = cz_or(cz_or(cz_eq(next, ' '), cz_eq(next, '\t')),
+                            cz_or(cz_eq(next, '\r'), cz_eq(next, '\n')));
+            mask = cz_or(mask, cz_or(breaks, cz_and(cz_eq(v, ' '), ws_next)));
+        }
+        bits = cz_movemask(mask);
+        if (bits)
+            return i + cz_ctz(bits);
+        i += CZ_BLOCK;
+    }
+#endif
+    return cz_find_special_scalar(s, i, n, collapse);
+}
+
+#endif
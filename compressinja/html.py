@@ -7,21 +7,42 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
+import warnings
 from jinja2.ext import Extension
 from jinja2.lexer import Token, describe_token
 from jinja2 import TemplateSyntaxError
 
+try:
+    from compressinja._html import normalize as _c_normalize
+except ImportError:
+    _c_normalize = None
 
-_tag_re = re.compile(r'(?:<(/?)([a-zA-Z0-9_-]+)\s*|(>\s*))(?s)')
-_ws_normalize_re = re.compile(r'[ \t\r\n]+')
+
+# one pass over a data token: group 2 is a tag name (group 1 marks closing
+# tags), group 3 ends a tag and group 4 is a whitespace run that needs
+# collapsing.  A lone space is already normalized, so it is left to the
+# verbatim text copied in between matches.
+_scan_re = re.compile(r'<(/?)([a-zA-Z0-9_-]+)[ \t\r\n\f\v]*|(>)|'
+                      r'([\t\r\n][ \t\r\n]*| [ \t\r\n]+)')
+_TAG_END = 3
+_WHITESPACE = 4
+
+_no_breaking = frozenset()
+
+# HtmlCompressor methods that a cached normalize result skips
+_tag_hooks = ('enter_tag', 'leave_tag', 'pop_tags', 'is_breaking')
 
 
 class StreamProcessContext(object):
+    __slots__ = ('stream', 'token', 'stack', 'in_tag', 'isolated_depth')
 
     def __init__(self, stream):
         self.stream = stream
         self.token = None
         self.stack = []
+        # name of the tag whose markup is being scanned, None between tags
+        self.in_tag = None
+        self.isolated_depth = 0
 
     def fail(self, message):
         raise TemplateSyntaxError(message, self.token.lineno,
@@ -37,114 +58,199 @@ def _make_dict_from_listing(listing):
 
 
 class HtmlCompressor(Extension):
-    isolated_elements = set(['script', 'style', 'noscript', 'textarea'])
-    void_elements = set(['br', 'img', 'area', 'hr', 'param', 'input',
-                         'embed', 'col'])
-    block_elements = set(['div', 'p', 'form', 'ul', 'ol', 'li', 'table', 'tr',
-                          'tbody', 'thead', 'tfoot', 'tr', 'td', 'th', 'dl',
-                          'dt', 'dd', 'blockquote', 'h1', 'h2', 'h3', 'h4',
-                          'h5', 'h6', 'pre'])
+    isolated_elements = frozenset(['script', 'style', 'noscript', 'textarea'])
+    void_elements = frozenset(['br', 'img', 'area', 'hr', 'param', 'input',
+                               'embed', 'col'])
+    block_elements = frozenset(['div', 'p', 'form', 'ul', 'ol', 'li', 'table',
+                                'tr', 'tbody', 'thead', 'tfoot', 'td', 'th',
+                                'dl', 'dt', 'dd', 'blockquote', 'h1', 'h2',
+                                'h3', 'h4', 'h5', 'h6', 'pre'])
     breaking_rules = _make_dict_from_listing([
-        (['p'], set(['#block'])),
-        (['li'], set(['li'])),
-        (['td', 'th'], set(['td', 'th', 'tr', 'tbody', 'thead', 'tfoot'])),
-        (['tr'], set(['tr', 'tbody', 'thead', 'tfoot'])),
-        (['thead', 'tbody', 'tfoot'], set(['thead', 'tbody', 'tfoot'])),
-        (['dd', 'dt'], set(['dl', 'dt', 'dd']))
+        (['p'], frozenset(['#block'])),
+        (['li'], frozenset(['li'])),
+        (['td', 'th'], frozenset(['td', 'th', 'tr', 'tbody', 'thead',
+                                  'tfoot'])),
+        (['tr'], frozenset(['tr', 'tbody', 'thead', 'tfoot'])),
+        (['thead', 'tbody', 'tfoot'], frozenset(['thead', 'tbody', 'tfoot'])),
+        (['dd', 'dt'], frozenset(['dl', 'dt', 'dd']))
     ])
 
+    #: number of normalized data tokens remembered per environment.  Markup
+    #: repeated through includes, macros and loops is scanned only once.
+    #: Zero or less disables the cache.  It is also disabled for subclasses
+    #: that override the tag handling, because a hit skips those methods.
+    normalize_cache_size = 4096
+
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        cls = type(self)
+        if self.normalize_cache_size > 0 and \
+           all(getattr(cls, name) == getattr(HtmlCompressor, name)
+               for name in _tag_hooks):
+            self.normalize_cache = {}
+        else:
+            self.normalize_cache = None
+        if cls.is_isolated != HtmlCompressor.is_isolated:
+            warnings.warn('%s.is_isolated is no longer called, override '
+                          'enter_tag and pop_tags instead' % cls.__name__,
+                          DeprecationWarning, stacklevel=2)
+        # breaking_rules with '#block' resolved against block_elements of
+        # this class, so is_breaking is a single lookup
+        self.closed_by = {}
+        for other_tag, breaking in self.breaking_rules.items():
+            if '#block' in breaking:
+                breaking = breaking | self.block_elements
+            self.closed_by[other_tag] = breaking
+
     def is_isolated(self, stack):
+        """Deprecated and unused.  Open isolated elements are counted in
+        ``ctx.isolated_depth``, incremented by :meth:`enter_tag` and
+        decremented by :meth:`pop_tags`, so overriding this method has no
+        effect.
+        """
+        warnings.warn('is_isolated is deprecated, check ctx.isolated_depth '
+                      'instead', DeprecationWarning, stacklevel=2)
         for tag in reversed(stack):
             if tag in self.isolated_elements:
                 return True
         return False
 
     def is_breaking(self, tag, other_tag):
-        breaking = self.breaking_rules.get(other_tag)
-        return breaking and (tag in breaking or
-            ('#block' in breaking and tag in self.block_elements))
+        return tag in self.closed_by.get(other_tag, _no_breaking)
 
     def enter_tag(self, tag, ctx):
         while ctx.stack and self.is_breaking(tag, ctx.stack[-1]):
             self.leave_tag(ctx.stack[-1], ctx)
         if tag not in self.void_elements:
             ctx.stack.append(tag)
+            if tag in self.isolated_elements:
+                ctx.isolated_depth += 1
+
+    def pop_tags(self, ctx, idx=-1):
+        """Removes ``ctx.stack[idx:]``, the innermost open tag by default."""
+        stack = ctx.stack
+        for tag in stack[idx:]:
+            if tag in self.isolated_elements:
+                ctx.isolated_depth -= 1
+        del stack[idx:]
 
     def leave_tag(self, tag, ctx):
         if not ctx.stack:
             ctx.fail('Tried to leave "%s" but something closed '
                      'it already' % tag)
         if tag == ctx.stack[-1]:
-            ctx.stack.pop()
+            self.pop_tags(ctx)
             return
-        for idx, other_tag in enumerate(reversed(ctx.stack)):
+        stack = ctx.stack
+        for idx in range(len(stack) - 1, -1, -1):
+            other_tag = stack[idx]
             if other_tag == tag:
-                for num in xrange(idx + 1):
-                    ctx.stack.pop()
+                self.pop_tags(ctx, idx)
+                return
             elif not self.breaking_rules.get(other_tag):
                 break
 
     def normalize(self, ctx):
+        # the output depends on the open tags, so they are part of the key
+        # and the state they are left in is restored on a hit
+        if self.normalize_cache is None:
+            return self.normalize_uncached(ctx)
+        key = (ctx.token.value, tuple(ctx.stack), ctx.in_tag)
+        cached = self.normalize_cache.get(key)
+        if cached is not None:
+            value, stack, ctx.in_tag, ctx.isolated_depth = cached
+            ctx.stack[:] = stack
+            return value
+        value = self.normalize_uncached(ctx)
+        if len(self.normalize_cache) >= self.normalize_cache_size:
+            self.normalize_cache.clear()
+        self.normalize_cache[key] = (value, tuple(ctx.stack), ctx.in_tag,
+                                     ctx.isolated_depth)
+        return value
+
+    def normalize_uncached(self, ctx):
+        value = ctx.token.value
         pos = 0
         buffer = []
-        def write_data(value):
-            if not self.is_isolated(ctx.stack):
-                value = _ws_normalize_re.sub(' ', value)
-            buffer.append(value)
-
-        for match in _tag_re.finditer(ctx.token.value):
-            closes, tag, sole = match.groups()
-            preamble = ctx.token.value[pos:match.start()]
-            write_data(preamble)
-            if sole:
-                write_data(sole)
+        append = buffer.append
+        whitespace, tag_end = _WHITESPACE, _TAG_END
+        enter_tag, leave_tag = self.enter_tag, self.leave_tag
+        isolated = self.isolated_elements
+        # inside an isolated element only the markup of the element's own
+        # tags is collapsed, anything else that looks like a tag is content
+        collapse = not ctx.isolated_depth or ctx.in_tag in isolated
+
+        for match in _scan_re.finditer(value):
+            start = match.start()
+            if pos != start:
+                append(value[pos:start])
+            kind = match.lastindex
+            if kind == whitespace:
+                append(collapse and u' ' or match.group())
             else:
-                buffer.append(match.group())
-                (closes and self.leave_tag or self.enter_tag)(tag, ctx)
+                if kind == tag_end:
+                    ctx.in_tag = None
+                    append(u'>')
+                else:
+                    closes, tag = match.group(1, 2)
+                    append(match.group())
+                    # in an isolated element only its own end tag is markup
+                    if not ctx.isolated_depth or \
+                       closes and tag == ctx.stack[-1]:
+                        if closes:
+                            leave_tag(tag, ctx)
+                        else:
+                            enter_tag(tag, ctx)
+                        ctx.in_tag = tag
+                collapse = not ctx.isolated_depth or ctx.in_tag in isolated
             pos = match.end()
 
-        write_data(ctx.token.value[pos:])
+        append(value[pos:])
         return u''.join(buffer)
 
+    if _c_normalize is not None:
+        normalize_uncached = _c_normalize
+
     def filter_stream(self, stream):
         ctx = StreamProcessContext(stream)
+        normalize = self.normalize
         for token in stream:
             if token.type != 'data':
                 yield token
                 continue
             ctx.token = token
-            value = self.normalize(ctx)
-            yield Token(token.lineno, 'data', value)
+            yield Token(token.lineno, 'data', normalize(ctx))
 
 
 class SelectiveHtmlCompressor(HtmlCompressor):
 
     def filter_stream(self, stream):
         ctx = StreamProcessContext(stream)
+        normalize = self.normalize
+        skip, look = stream.skip, stream.look
         strip_depth = 0
         while 1:
-            if stream.current.type == 'block_begin':
-                if stream.look().test('name:strip') or \
-                   stream.look().test('name:endstrip'):
-                    stream.skip()
-                    if stream.current.value == 'strip':
-                        strip_depth += 1
-                    else:
-                        strip_depth -= 1
-                        if strip_depth < 0:
-                            ctx.fail('Unexpected tag endstrip')
-                    stream.skip()
-                    if stream.current.type != 'block_end':
-                        ctx.fail('expected end of block, got %s' %
-                                 describe_token(stream.current))
-                    stream.skip()
-            if strip_depth > 0 and stream.current.type == 'data':
-                ctx.token = stream.current
-                value = self.normalize(ctx)
-                yield Token(stream.current.lineno, 'data', value)
+            current = stream.current
+            if current.type == 'block_begin' and \
+               look().test_any('name:strip', 'name:endstrip'):
+                skip()
+                ctx.token = current = stream.current
+                if current.value == 'strip':
+                    strip_depth += 1
+                else:
+                    strip_depth -= 1
+                    if strip_depth < 0:
+                        ctx.fail('Unexpected tag endstrip')
+                skip()
+                ctx.token = current = stream.current
+                if current.type != 'block_end':
+                    ctx.fail('expected end of block, got %s' %
+                             describe_token(current))
+                skip()
+                current = stream.current
+            if strip_depth > 0 and current.type == 'data':
+                ctx.token = current
+                yield Token(current.lineno, 'data', normalize(ctx))
             else:
-                yield stream.current
-            stream.next()
-
-
-
+                yield current
+            next(stream)
@@ -1,9 +1,24 @@
-from distutils.core import setup
+from distutils.core import setup, Extension
 try:
-	from setuptools import setup
+	from setuptools import setup, Extension
 except:
 	pass
 
+try:
+	from Cython.Build import cythonize
+except ImportError:
+	cythonize = None
+
+# the C version of HtmlCompressor.normalize is optional, compressinja
+# falls back to pure Python if it cannot be built
+if cythonize is not None:
+	ext_modules = cythonize([
+		Extension("compressinja._html", ["compressinja/_html.pyx"],
+		          depends=["compressinja/_simd.h"], optional=True),
+	])
+else:
+	ext_modules = []
+
 setup(
     name = "compressinja",
     version = "0.0.2",
@@ -13,4 +28,5 @@ setup(
     keywords = "jinja2 html compress",
     packages=['compressinja'],
     install_requires = ["jinja2"],
+    ext_modules = ext_modules,
 )
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import importlib
+import os
+import sys
+import warnings
+
+import pytest
+from jinja2 import Environment, TemplateSyntaxError
+from jinja2.lexer import Token
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import compressinja
+from compressinja import html
+
+
+def load_pure_html():
+    """Import a second copy of compressinja.html that does not use the C
+    extension, leaving the regular module in place."""
+    saved = sys.modules.pop('compressinja.html')
+    saved_c = sys.modules.get('compressinja._html')
+    sys.modules['compressinja._html'] = None
+    try:
+        return importlib.import_module('compressinja.html')
+    finally:
+        sys.modules['compressinja.html'] = compressinja.html = saved
+        if saved_c is None:
+            del sys.modules['compressinja._html']
+        else:
+            sys.modules['compressinja._html'] = saved_c
+
+
+pure_html = load_pure_html()
+assert pure_html._c_normalize is None
+needs_c = pytest.mark.skipif(html._c_normalize is None,
+                             reason='C extension is not built')
+
+
+@pytest.fixture(params=[
+    'python',
+    pytest.param('c', marks=needs_c),
+])
+def module(request):
+    return request.param == 'c' and html or pure_html
+
+
+def compress(module, source, extension='HtmlCompressor', **context):
+    env = Environment(extensions=[getattr(module, extension)])
+    return env.from_string(source).render(**context)
+
+
+def trace(module, source):
+    """Normalizes the data tokens of `source` one by one and records the
+    output together with the context state after each of them."""
+    env = Environment(extensions=[module.HtmlCompressor])
+    ext = list(env.extensions.values())[0]
+    ctx = module.StreamProcessContext(None)
+    rv = []
+    for lineno, kind, value in env.lex(source):
+        if kind == 'data':
+            ctx.token = Token(lineno, kind, value)
+            rv.append((ext.normalize_uncached(ctx), list(ctx.stack),
+                       ctx.in_tag, ctx.isolated_depth))
+    return rv
+
+
+TEMPLATES = [
+    u'''
+    <html>
+      <head>
+        <title>{{ title }}</title>
+      </head>
+      <script type=text/javascript>
+        if (foo < 42) {
+          document.write('Foo < Bar');
+        }
+      </script>
+      <body>
+        <li><a href="{{ href }}">{{ title }}</a><br>Test   Foo
+        <li><a href="{{ href }}">{{ title }}</a><img src=test.png>
+      </body>
+    </html>''',
+    u'''<!DOCTYPE html>
+    <pre class="x   y">
+       keep   this
+    </pre>  <div   id="a"
+         class="b">  text  <p>one  <p>two</div>
+    <table>
+     <tr><td> a <td> b
+     <tr><th> c </table>
+    <dl><dt> x <dd> y <dt> z </dl>
+    <textarea name=t>
+      raw   text
+    </textarea>
+    <ul>{% for i in items %}
+       <li>  {{ i }}   \xfcn\xefc\xf8d\xe9  \U0001F600 {% endfor %}</ul>
+    <style>
+      a   { color: red }
+    </style>
+    <div>{{ a }}   <span  title="{{ b }}"   data-x="1">{{ c }}</span>  </div>
+    <script src="x.js"
+        defer></script>
+    <br/>   <hr> <img src="a.png"  />''',
+    u'<div>{% if x %}   <p>  a {% else %}  <p>  b {% endif %}</div>   ',
+    u'<ul><li>a<li>b<li>c</ul><ol><li><ul><li>x</ul></ol>',
+    u'<p>' + u'  lorem   ipsum\n\tdolor  <b>sit</b>   amet  ' * 40 + u'</p>',
+    u'<p>a \f\v b  \xa0  c</p> < p> a <3 </ >',
+    u'<script>\nfor (var i=0;i<n;i++) { // loop\n  foo();\n}\n</script>'
+    u'   <p>  a  </p>',
+]
+
+
+@needs_c
+@pytest.mark.parametrize('source', TEMPLATES)
+def test_c_matches_python(source):
+    assert trace(html, source) == trace(pure_html, source)
+
+
+def test_compress(module):
+    assert compress(module, TEMPLATES[0], title=42, href='index.html') == (
+        u' <html> <head> <title>42</title> </head> '
+        u'<script type=text/javascript>\n'
+        u'        if (foo < 42) {\n'
+        u"          document.write('Foo < Bar');\n"
+        u'        }\n'
+        u'      </script> <body> <li><a href="index.html">42</a><br>Test Foo '
+        u'<li><a href="index.html">42</a><img src=test.png> </body> </html>'
+    )
+
+
+def test_selective_compress(module):
+    source = u'''Normal   <span>  unchanged </span>
+    {% strip %}Stripped <span class=foo  >   test   </span>
+    <p>
+      Foo<br>Bar
+    {% endstrip %}  after    text'''
+    assert compress(module, source, 'SelectiveHtmlCompressor') == (
+        u'Normal   <span>  unchanged </span>\n    '
+        u'Stripped <span class=foo > test </span> <p> Foo<br>Bar '
+        u'  after    text'
+    )
+
+
+def test_tag_like_text_in_isolated_element(module):
+    script = u'<script>\nfor (var i=0;i<n;i++) { // loop\n  foo();\n}\n</script>'
+    assert compress(module, script) == script
+    textarea = u'<textarea>a<b  c\n d</textarea>'
+    assert compress(module, textarea) == textarea
+
+
+@pytest.mark.parametrize(('source', 'expected'), [
+    (u'<script>if(a<b)c()</script>\n\n   <div>   <p>  x   y  </p></div>',
+     u'<script>if(a<b)c()</script> <div> <p> x y </p></div>'),
+    (u'<textarea>a<b  c\n</b></textarea>   <p>  x   y  </p>',
+     u'<textarea>a<b  c\n</b></textarea> <p> x y </p>'),
+])
+def test_markup_after_isolated_element(module, source, expected):
+    assert trace(module, source) == [(expected, [], None, 0)]
+
+
+def test_isolated_element_attributes(module):
+    assert compress(module, u'<script  src="x.js"\n    defer>\n  a\n</script>'
+                    ) == u'<script  src="x.js" defer>\n  a\n</script>'
+
+
+def test_implicit_close(module):
+    states = trace(module, u'<div><ul><li><p>a</ul>{{ x }}'
+                           u'<table><tr><td>a</table>{{ x }}'
+                           u'<script><li>x</script>{{ x }}'
+                           u'<div><li><div><li>x</div>')
+    assert [(stack, depth) for _, stack, _, depth in states] == [
+        ([u'div'], 0),
+        ([u'div'], 0),
+        ([u'div'], 0),
+        ([u'div', u'div', u'li'], 0),
+    ]
+
+
+def test_lone_surrogate(module):
+    assert compress(module, u'<p>a\ud800  b</p>') == u'<p>a\ud800 b</p>'
+
+
+def test_cache_matches_uncached(module):
+    source = (u'<ul>{{ x }}<li>  a  {{ x }}<li>  a  {{ x }}</ul>'
+              u'<script  src=a>{{ x }}  b  </script>{{ x }}  b  ') * 3
+    env = Environment(extensions=[module.HtmlCompressor])
+    ext = list(env.extensions.values())[0]
+    rv = []
+    for normalize in ext.normalize, ext.normalize_uncached:
+        ctx = module.StreamProcessContext(None)
+        states = []
+        for lineno, kind, value in env.lex(source):
+            if kind == 'data':
+                ctx.token = Token(lineno, kind, value)
+                states.append((normalize(ctx), list(ctx.stack), ctx.in_tag,
+                               ctx.isolated_depth))
+        rv.append(states)
+    assert ext.normalize_cache
+    assert rv[0] == rv[1]
+
+
+def test_cache_respects_overrides(module):
+    entered = []
+
+    class Compressor(module.HtmlCompressor):
+        def enter_tag(self, tag, ctx):
+            entered.append(tag)
+            module.HtmlCompressor.enter_tag(self, tag, ctx)
+
+    env = Environment(extensions=[Compressor])
+    env.from_string(u'<p>x</p>')
+    env.from_string(u'<p>x</p>')
+    assert entered == [u'p', u'p']
+
+
+def test_cache_disabled(module):
+    class Compressor(module.HtmlCompressor):
+        normalize_cache_size = 0
+
+    env = Environment(extensions=[Compressor])
+    assert env.from_string(u'<p>  x  </p>').render() == u'<p> x </p>'
+    assert list(env.extensions.values())[0].normalize_cache is None
+
+
+def test_is_isolated_deprecated(module):
+    class Compressor(module.HtmlCompressor):
+        def is_isolated(self, stack):
+            return False
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        Environment(extensions=[Compressor])
+        ext = Environment(extensions=[module.HtmlCompressor]).extensions
+        assert list(ext.values())[0].is_isolated([u'div', u'script'])
+    assert [w.category for w in caught] == [DeprecationWarning] * 2
+    assert 'Compressor.is_isolated' in str(caught[0].message)
+
+
+@pytest.mark.parametrize(('source', 'message'), [
+    (u'a {% endstrip %}', 'Unexpected tag endstrip'),
+    (u'{% strip x %}a{% endstrip %}', 'expected end of block, got x'),
+])
+def test_selective_errors(module, source, message):
+    env = Environment(extensions=[module.SelectiveHtmlCompressor])
+    with pytest.raises(TemplateSyntaxError) as excinfo:
+        env.from_string(source)
+    assert excinfo.value.message == message
+    assert excinfo.value.lineno == 1